@@ -10,65 +10,357 @@ import sys
 import json
 import asyncio
 import logging
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 import time
+import functools
+import copy
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 from datetime import datetime
-from typing import Dict, Any, Optional, Tuple, List
+from typing import Dict, Any, Optional, Tuple, List, Callable, Awaitable, Set, Deque, Hashable, AsyncIterator
 from pathlib import Path
+from types import SimpleNamespace
+from dataclasses import dataclass
+from enum import Enum
 import tempfile
+import shutil
 import tarfile
+import secrets
+from urllib.parse import urlsplit
 
 try:
+    import aiohttp
+    from aiohttp import web
     import telebot
+    from telebot import asyncio_helper
     from telebot.async_telebot import AsyncTeleBot
-    from telebot.types import InlineKeyboardMarkup
+    from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate
+    from telebot.types import InlineKeyboardMarkup, CallbackQuery
     from telebot.util import quick_markup
 except ImportError:
     print("FATAL ERROR: 'pyTelegramBotAPI' is not installed. Please run 'pip install pyTelegramBotAPI'.")
     sys.exit(1)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import aiofiles
+    import aiofiles.os
+except ImportError:
+    print("FATAL ERROR: 'aiofiles' is not installed. Please run 'pip install aiofiles'.")
+    sys.exit(1)
+
 # --- Constants ---
 SCRIPT_DIR = Path(__file__).resolve().parent
 CONFIG_FILE = SCRIPT_DIR / "config.json"
 MAIN_PANEL_SCRIPT = SCRIPT_DIR / "marzban_panel.py"
+VENV_PYTHON = SCRIPT_DIR / "venv" / "bin" / "python3"
+PANEL_PYTHON = str(VENV_PYTHON) if VENV_PYTHON.exists() else (shutil.which("python3") or "python3")
 LOG_FILE = SCRIPT_DIR / "marzban_backup.log"
 BOT_LOG_FILE = SCRIPT_DIR / "marzban_bot.log"
 BOT_STATE_FILE = SCRIPT_DIR / "bot_state.json"
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_BUFFER_LIMIT = 1024 * 1024
+PROGRESS_UPDATE_INTERVAL = 1.5
+OUTPUT_TAIL_LINES = 200
+PANEL_SCRIPT_TIMEOUT = 900
+# sudo relays SIGTERM to the panel but cannot relay SIGKILL, so a timed-out run gets this long to exit first.
+PANEL_TERMINATE_GRACE = 10
+HTTP_CONNECTION_LIMIT = 10
+HTTP_KEEPALIVE_TIMEOUT = 75
+LOG_TAIL_LINES = 20
+POLLING_BACKOFF_INITIAL = 1
+POLLING_BACKOFF_MAX = 300
+# AsyncTeleBot passes `timeout` to getUpdates as the server-side long-poll wait; the HTTP read must outlast it.
+LONG_POLLING_TIMEOUT = 120
+POLLING_REQUEST_TIMEOUT = LONG_POLLING_TIMEOUT + 15
+ALLOWED_UPDATES = ['message', 'callback_query']
+TELEGRAM_API_SERVER = "https://api.telegram.org"
+TELEGRAM_FILE_URL = TELEGRAM_API_SERVER + "/file/bot{0}/{1}"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_READ_TIMEOUT = 60
+BACKUP_ARCHIVE_ROOTS = {'filesystem', 'db_dumps'}
+GZIP_MAGIC = b'\x1f\x8b'
+LOG_TAIL_CHUNK_SIZE = 4096
+HTTP_DNS_CACHE_TTL = 300
+MARKDOWN_SPECIAL_CHARS = frozenset('*_`[')
+EDIT_MIN_INTERVAL = 1.0
+EDIT_TRACKED_MESSAGES = 256
+TELEGRAM_GLOBAL_RATE = 30
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_MAX_CONNECTIONS = 2
 
-EMOJI: Dict[str, str] = {
-    "PANEL": "📱", "BACKUP": "📦", "RESTORE": "🔄", "AUTO": "⚙️",
-    "STATUS": "📊", "LOGS": "📋", "SUCCESS": "✅", "ERROR": "❌",
-    "WAIT": "⏳", "INFO": "🔵", "WARNING": "⚠️", "BACK": "⬅️", "DANGER": "🛑",
-    "EDIT": "📝", "CLOCK": "⏱️", "CONFIRM": "👍", "TOGGLE_ON": "🟢", "TOGGLE_OFF": "🔴"
-}
+EMOJI = SimpleNamespace(
+    PANEL="📱", BACKUP="📦", RESTORE="🔄", AUTO="⚙️",
+    STATUS="📊", LOGS="📋", SUCCESS="✅", ERROR="❌",
+    WAIT="⏳", INFO="🔵", WARNING="⚠️", BACK="⬅️", DANGER="🛑",
+    EDIT="📝", CLOCK="⏱️", CONFIRM="👍", TOGGLE_ON="🟢", TOGGLE_OFF="🔴"
+)
 
 # --- Logging Setup ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(BOT_LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_file_handler = RotatingFileHandler(BOT_LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8', delay=True)
+log_stream_handler = logging.StreamHandler()
+for _handler in (log_file_handler, log_stream_handler):
+    _handler.setFormatter(log_formatter)
+log_listener = QueueListener(log_queue, log_file_handler, log_stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+log_queue_handler = QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.getLogger().addHandler(log_queue_handler)
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def json_loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def json_dumps(data: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=4).encode('utf-8')
+
+
+@functools.lru_cache(maxsize=1)
+def format_backup_time(iso_str: str) -> str:
+    """Formats a stored ISO timestamp for display; cached since it only changes after a backup."""
+    try:
+        return datetime.fromisoformat(iso_str).isoformat(sep=' ', timespec='minutes')
+    except (ValueError, TypeError):
+        logger.warning(f"Could not parse date: '{iso_str}'. Displaying as is.")
+        return iso_str
+
+
+def configure_api_server(api_server: Optional[str]):
+    """Points AsyncTeleBot at a self-hosted Bot API server, which lifts the 20 MB download / 50 MB upload caps."""
+    if not api_server:
+        return
+    base_url = api_server.rstrip('/')
+    asyncio_helper.API_URL = base_url + "/bot{0}/{1}"
+    asyncio_helper.FILE_URL = base_url + "/file/bot{0}/{1}"
+    logger.info(f"Using Bot API server: {base_url}")
+
+
+TELEGRAM_API_ERRORS = (telebot.apihelper.ApiTelegramException, asyncio_helper.ApiTelegramException)
+TELEGRAM_NETWORK_ERRORS = (asyncio_helper.RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class KeepAliveSessionManager(asyncio_helper.SessionManager):
+    """Keeps the shared Telegram API connection and DNS lookups warm between polls."""
+    async def create_session(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=HTTP_CONNECTION_LIMIT,
+            ssl=getattr(self, 'ssl_context', True),
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        ))
+        return self.session
+
+
+class AdminOnlyMiddleware(BaseMiddleware):
+    """Drops updates from anyone but the admin before they reach handler dispatch."""
+    def __init__(self, admin_id: int):
+        super().__init__()
+        self.admin_id = admin_id
+        self.update_types = ['message', 'callback_query']
+
+    async def pre_process(self, message_or_call, data):
+        chat_id = message_or_call.message.chat.id if isinstance(message_or_call, CallbackQuery) else message_or_call.chat.id
+        if chat_id != self.admin_id:
+            logger.warning(f"Unauthorized access attempt from chat_id: {chat_id}")
+            return CancelUpdate()
+
+    async def post_process(self, message_or_call, data, exception):
+        pass
+
+
+class PanelLogCollector(logging.Handler):
+    """Collects the panel's log messages when it runs in-process instead of as a subprocess."""
+    def __init__(self):
+        super().__init__()
+        self.lines: Deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    def emit(self, record: logging.LogRecord):
+        self.lines.append(record.getMessage())
+
+
+class TokenBucket:
+    """Async token bucket shared by all outbound calls so bursts stay under Telegram's global limit."""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class KeyedLocks:
+    """Per-key asyncio locks that are dropped once nobody holds or waits on them."""
+    def __init__(self):
+        self._entries: Dict[Hashable, List[Any]] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._entries.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._entries[key]
+
+
+def validate_backup_archive(archive_path: Path):
+    """Raises ValueError unless the archive looks like a panel backup, stopping at the first matching member."""
+    try:
+        with open(archive_path, 'rb') as f:
+            if f.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+                raise ValueError("Not a gzip file.")
+        with tarfile.open(archive_path, "r:gz") as tar:
+            for member in tar:
+                parts = Path(member.name).parts
+                if parts and parts[0] in BACKUP_ARCHIVE_ROOTS:
+                    return
+    except (tarfile.TarError, OSError, EOFError) as e:
+        raise ValueError(f"Not a valid .tar.gz archive: {e}")
+    raise ValueError("Archive does not contain 'filesystem' or 'db_dumps' directories.")
+
+
+class ConversationStep(Enum):
+    AWAITING_INTERVAL = 1
+    AWAITING_RESTORE_FILE = 2
+
+
+@dataclass(frozen=True)
+class ConversationState:
+    """What the bot is waiting for from a chat, and which message to edit when it arrives."""
+    step: ConversationStep
+    message_id: int
+
+
+@dataclass(frozen=True)
+class TelegramSettings:
+    """Typed view of the config's 'telegram' section."""
+    bot_token: Optional[str] = None
+    admin_chat_id: Optional[str] = None
+    backup_interval: Optional[str] = None
+    api_server: Optional[str] = None
+    webhook: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'TelegramSettings':
+        tg = config.get('telegram') or {}
+        return cls(
+            bot_token=tg.get('bot_token'),
+            admin_chat_id=tg.get('admin_chat_id'),
+            backup_interval=tg.get('backup_interval'),
+            api_server=tg.get('api_server'),
+            webhook=tg.get('webhook'),
+        )
+
+
+def open_temp_beside(path: Path) -> Tuple[int, Path]:
+    """Creates a uniquely named temp file next to `path`, carrying over its permissions (0600 if it is new)."""
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        os.fchmod(fd, path.stat().st_mode & 0o7777)
+    except FileNotFoundError:
+        pass
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_name)
+        raise
+    return fd, Path(tmp_name)
+
+
 class StateManager:
-    """Handles sync reading/writing of state/config files in a centralized way."""
+    """Handles reading/writing of state/config files in a centralized way (sync for startup, async for handlers)."""
     def __init__(self, config_path: Path, state_path: Path):
         self.config_path = config_path
         self.state_path = state_path
+        self._cache: Dict[Path, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+        # Serializes async read-modify-write cycles so concurrent handlers cannot lose updates or share a temp file.
+        self._write_lock = asyncio.Lock()
+
+    @staticmethod
+    def _stat_key(st: os.stat_result) -> Tuple[int, int]:
+        return st.st_mtime_ns, st.st_size
+
+    def _get_cached(self, path: Path, stat_key: Tuple[int, int]) -> Optional[Dict[str, Any]]:
+        # Callers get their own copy, so a mutation that is never saved cannot leak into the cache.
+        cached = self._cache.get(path)
+        if cached and cached[0] == stat_key:
+            return copy.deepcopy(cached[1])
+        return None
     
     def _load_json(self, path: Path) -> Dict[str, Any]:
-        if not path.exists(): return {}
         try:
-            with path.open('r', encoding='utf-8') as f:
-                return json.load(f)
+            stat_key = self._stat_key(path.stat())
+        except FileNotFoundError:
+            self._cache.pop(path, None)
+            return {}
+        cached = self._get_cached(path, stat_key)
+        if cached is not None:
+            return cached
+        try:
+            data = json_loads(path.read_bytes())
+        except (json.JSONDecodeError, FileNotFoundError): return {}
+        self._cache[path] = (stat_key, data)
+        return copy.deepcopy(data)
+
+    async def _aload_json(self, path: Path) -> Dict[str, Any]:
+        try:
+            stat_key = self._stat_key(await aiofiles.os.stat(path))
+        except FileNotFoundError:
+            self._cache.pop(path, None)
+            return {}
+        cached = self._get_cached(path, stat_key)
+        if cached is not None:
+            return cached
+        try:
+            async with aiofiles.open(path, 'rb') as f:
+                data = json_loads(await f.read())
         except (json.JSONDecodeError, FileNotFoundError): return {}
+        self._cache[path] = (stat_key, data)
+        return copy.deepcopy(data)
 
-    def _save_json(self, path: Path, data: Dict[str, Any]):
-        with path.open('w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4)
+    async def _asave_json(self, path: Path, data: Dict[str, Any]):
+        fd, tmp_path = open_temp_beside(path)
+        try:
+            async with aiofiles.open(fd, 'wb') as f:
+                await f.write(json_dumps(data))
+                await f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+            stat_key = self._stat_key(await aiofiles.os.stat(tmp_path))
+            await aiofiles.os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self._cache[path] = (stat_key, copy.deepcopy(data))
 
     def get_config(self) -> Dict[str, Any]:
         return self._load_json(self.config_path)
@@ -76,15 +368,28 @@ class StateManager:
     def get_state(self) -> Dict[str, Any]:
         return self._load_json(self.state_path)
 
-    def update_config(self, new_data: Dict[str, Any]):
-        current_config = self.get_config()
-        current_config.update(new_data)
-        self._save_json(self.config_path, current_config)
+    async def aget_config(self) -> Dict[str, Any]:
+        return await self._aload_json(self.config_path)
+
+    async def aget_telegram_settings(self) -> TelegramSettings:
+        return TelegramSettings.from_config(await self.aget_config())
 
-    def update_state(self, key: str, value: Any):
-        current_state = self.get_state()
-        current_state[key] = value
-        self._save_json(self.state_path, current_state)
+    async def aget_state(self) -> Dict[str, Any]:
+        return await self._aload_json(self.state_path)
+
+    async def amodify_config(self, mutate: Callable[[Dict[str, Any]], None]):
+        """Applies `mutate` to the current config and persists it, one writer at a time."""
+        async with self._write_lock:
+            config_data = await self.aget_config()
+            mutate(config_data)
+            await self._asave_json(self.config_path, config_data)
+
+    async def aupdate_state(self, key: str, value: Any):
+        async with self._write_lock:
+            current_state = await self.aget_state()
+            if key in current_state and current_state[key] == value: return
+            current_state[key] = value
+            await self._asave_json(self.state_path, current_state)
 
 
 class MarzbanControlBot:
@@ -102,47 +407,114 @@ class MarzbanControlBot:
     CB_LOGS_MENU = "view_logs"
     CB_VIEW_BACKUP_LOG = "view_backup_log"
     CB_VIEW_BOT_LOG = "view_bot_log"
+    # Presses that start a panel job; refused outright while another one is running.
+    PANEL_ACTIONS = frozenset({CB_DO_BACKUP, CB_AUTOBACKUP_DISABLE})
+
+    MAIN_MENU_TEMPLATE = (
+        "*{panel} Holographic Control Interface*\n\n"
+        "`System Time..: ` `{now}`\n"
+        "`Last Backup..: ` `{last_backup}`\n"
+        "`Auto Backup..: ` {auto_status}\n\n"
+        "Awaiting command..."
+    )
+    LOGS_MENU_TEXT = f"{EMOJI.LOGS} *مشاهده لاگ‌ها*\n\nکدام فایل لاگ را می‌خواهید مشاهده کنید؟ (نمایش ۲۰ خط آخر)"
+    RESTORE_WARNING_TEXT = (
+        f"{EMOJI.DANGER} *هشدار بسیار مهم*\n\n"
+        "این عمل تمام اطلاعات فعلی شما را با فایل بکاپ *جایگزین* می‌کند. این عمل غیرقابل بازگشت است.\n\n"
+        "آیا برای ادامه مطمئن هستید؟"
+    )
+    RESTORE_PROMPT_TEXT = f"{EMOJI.INFO} لطفاً فایل بکاپ با فرمت `.tar.gz` را ارسال کنید."
+    BUSY_ANSWER_TEXT = f"{EMOJI.WAIT} عملیات قبلی هنوز در حال اجراست."
+    PANEL_BUSY_TEXT = f"{EMOJI.WARNING} عملیات دیگری در حال اجراست. لطفاً پس از پایان آن دوباره تلاش کنید."
+    INTERVAL_PROMPT_TEXT = f"{EMOJI.CLOCK} لطفاً بازه زمانی بکاپ خودکار را به *دقیقه* وارد کنید (مثلا: `60`)."
+    INITIALIZING_TEXT = f"{EMOJI.WAIT} Initializing Interface..."
+    AUTOBACKUP_DISABLING_TEXT = f"{EMOJI.WAIT} در حال غیرفعال‌سازی..."
+    AUTOBACKUP_DISABLED_TEXT = f"{EMOJI.SUCCESS} بکاپ خودکار غیرفعال شد."
+    SCHEDULE_UPDATED_TEXT = f"{EMOJI.SUCCESS} زمان‌بندی با موفقیت به‌روز شد."
+    STATUS_LOADING_TEXT = f"{EMOJI.WAIT} در حال دریافت اطلاعات سیستم..."
+    LOG_LOADING_TEXT = f"{EMOJI.WAIT} در حال خواندن فایل لاگ..."
+    INVALID_INTERVAL_TEXT = f"{EMOJI.ERROR} ورودی نامعتبر است. لطفاً فقط یک عدد صحیح مثبت وارد کنید."
+    INVALID_FILE_TEXT = f"{EMOJI.ERROR} فایل نامعتبر است. لطفاً فایل با فرمت `.tar.gz` ارسال کنید."
+    DOWNLOADING_TEXT = f"{EMOJI.WAIT} در حال دانلود فایل..."
+    PROGRESS_TEMPLATE = f"{EMOJI.WAIT} عملیات در حال انجام...\n\n{{line}}"
 
-    def __init__(self, token: str, admin_id: int):
-        self.bot = AsyncTeleBot(token, parse_mode="Markdown")
+    def __init__(self, token: str, admin_id: int, state_manager: Optional[StateManager] = None):
+        asyncio_helper.session_manager = KeepAliveSessionManager()
+        self.bot = AsyncTeleBot(token)
         self.admin_id = admin_id
-        self.state_manager = StateManager(CONFIG_FILE, BOT_STATE_FILE)
-        self.conversational_states: Dict[int, Dict[str, Any]] = {}
+        self.bot.setup_middleware(AdminOnlyMiddleware(admin_id))
+        self.state_manager = state_manager or StateManager(CONFIG_FILE, BOT_STATE_FILE)
+        self.conversational_states: Dict[int, ConversationState] = {}
+        self._conversation_locks = KeyedLocks()
+        # Hash of the newest content requested per message; pending or in-flight edits deliver it.
+        self._last_requested: Dict[Tuple[int, int], int] = {}
+        self._edit_times: Dict[Tuple[int, int], float] = {}
+        self._send_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+        # Ordered by last edit so the bookkeeping of old messages can be evicted.
+        self._edit_seq: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self._markup_json_cache: Dict[int, Tuple[InlineKeyboardMarkup, str]] = {}
+        self._panel_module = self._load_panel_module()
+        self._panel_lock = asyncio.Lock()
+        self._panel_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='panel')
+        self._dispatch_locks = KeyedLocks()
+        self._inflight_presses: Dict[Tuple[int, int], str] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._pending_displays: Dict[Tuple[int, int], asyncio.TimerHandle] = {}
+        self._main_menu_markup = self._get_main_menu_keyboard()
+        self._autobackup_markups = {
+            True: self._get_autobackup_menu_keyboard(True),
+            False: self._get_autobackup_menu_keyboard(False),
+        }
+        self._logs_menu_markup = self._get_logs_menu_keyboard()
+        self._restore_confirm_markup = self._get_restore_confirm_keyboard()
+        self._back_to_main_markup = self._get_back_keyboard(self.CB_MAIN_MENU)
+        self._back_to_logs_markup = self._get_back_keyboard(self.CB_LOGS_MENU)
+        self._action_map: Dict[str, Callable[[int, int], Awaitable[None]]] = {
+            self.CB_MAIN_MENU: self.display_main_menu,
+            self.CB_DO_BACKUP: self.handle_backup,
+            self.CB_RESTORE_START: self.handle_restore_start,
+            self.CB_RESTORE_CONFIRM: self.handle_restore_confirm,
+            self.CB_AUTOBACKUP_MENU: self.display_autobackup_menu,
+            self.CB_AUTOBACKUP_ENABLE: self.handle_autobackup_set_interval,
+            self.CB_AUTOBACKUP_DISABLE: self.handle_autobackup_disable,
+            self.CB_AUTOBACKUP_EDIT: self.handle_autobackup_set_interval,
+            self.CB_SYSTEM_STATUS: self.handle_system_status,
+            self.CB_LOGS_MENU: self.display_logs_menu,
+            self.CB_VIEW_BACKUP_LOG: functools.partial(self.handle_view_log, log_path=LOG_FILE),
+            self.CB_VIEW_BOT_LOG: functools.partial(self.handle_view_log, log_path=BOT_LOG_FILE),
+        }
         self._register_handlers()
 
     def _register_handlers(self):
         @self.bot.message_handler(commands=['start'])
-        @self.admin_only
         async def handle_start(message):
-            initial_msg = await self.bot.send_message(message.chat.id, f"{EMOJI['WAIT']} Initializing Interface...")
+            await self._send_bucket.acquire()
+            initial_msg = await self.bot.send_message(message.chat.id, self.INITIALIZING_TEXT)
             await self.display_main_menu(initial_msg.chat.id, initial_msg.message_id)
 
         @self.bot.callback_query_handler(func=lambda call: True)
-        @self.admin_only
         async def master_callback_handler(call):
-            await self.bot.answer_callback_query(call.id)
+            # Answer every query, stale or unknown ones included, so the client's spinner always stops.
+            handler = self._action_map.get(call.data)
+            if handler is None:
+                await self.bot.answer_callback_query(call.id)
+                return
             chat_id, msg_id = call.message.chat.id, call.message.message_id
-            
-            action_map = {
-                self.CB_MAIN_MENU: lambda: self.display_main_menu(chat_id, msg_id),
-                self.CB_DO_BACKUP: lambda: self.handle_backup(chat_id, msg_id),
-                self.CB_RESTORE_START: lambda: self.handle_restore_start(chat_id, msg_id),
-                self.CB_RESTORE_CONFIRM: lambda: self.handle_restore_confirm(chat_id, msg_id),
-                self.CB_AUTOBACKUP_MENU: lambda: self.display_autobackup_menu(chat_id, msg_id),
-                self.CB_AUTOBACKUP_ENABLE: lambda: self.handle_autobackup_set_interval(chat_id, msg_id),
-                self.CB_AUTOBACKUP_DISABLE: lambda: self.handle_autobackup_disable(chat_id, msg_id),
-                self.CB_AUTOBACKUP_EDIT: lambda: self.handle_autobackup_set_interval(chat_id, msg_id),
-                self.CB_SYSTEM_STATUS: lambda: self.handle_system_status(chat_id, msg_id),
-                self.CB_LOGS_MENU: lambda: self.display_logs_menu(chat_id, msg_id),
-                self.CB_VIEW_BACKUP_LOG: lambda: self.handle_view_log(chat_id, msg_id, LOG_FILE),
-                self.CB_VIEW_BOT_LOG: lambda: self.handle_view_log(chat_id, msg_id, BOT_LOG_FILE),
-            }
-            handler = action_map.get(call.data)
-            if handler:
-                await handler()
+            key = (chat_id, msg_id)
+            if key in self._inflight_presses or (call.data in self.PANEL_ACTIONS and self._panel_busy()):
+                # Refuse right away rather than queueing a second run behind the first.
+                await self.bot.answer_callback_query(call.id, self.BUSY_ANSWER_TEXT)
+                return
+            # Mark the press in flight before any await, so a rapid second tap sees it.
+            self._inflight_presses[key] = call.data
+            # Any button press abandons a pending prompt; handlers that prompt again set a fresh state.
+            self.conversational_states.pop(chat_id, None)
+            self._cancel_pending_display(chat_id, msg_id)
+            task = self._spawn(self._dispatch(handler, chat_id, msg_id))
+            task.add_done_callback(lambda _: self._inflight_presses.pop(key, None))
+            await self.bot.answer_callback_query(call.id)
 
         @self.bot.message_handler(content_types=['text', 'document'], func=lambda msg: self.conversational_states.get(msg.chat.id) is not None)
-        @self.admin_only
         async def handle_stateful_messages(message):
             chat_id = message.chat.id
             state_info = self.conversational_states.pop(chat_id, None)
@@ -151,300 +523,508 @@ class MarzbanControlBot:
             try: await self.bot.delete_message(chat_id, message.message_id)
             except Exception: pass
             
-            msg_id_to_edit = state_info['message_id']
-            state = state_info['state']
-            if state == 'awaiting_interval':
-                await self._process_interval_input(chat_id, msg_id_to_edit, message.text)
-            elif state == 'awaiting_restore_file':
-                await self._process_restore_file(message, msg_id_to_edit)
-
-    def admin_only(self, func):
-        async def wrapper(message_or_call):
-            chat_id = message_or_call.chat.id if hasattr(message_or_call, 'chat') else message_or_call.message.chat.id
-            if chat_id != self.admin_id:
-                logger.warning(f"Unauthorized access attempt from chat_id: {chat_id}")
-                return
-            await func(message_or_call)
-        return wrapper
+            # A double-tapped prompt must not start a second restore while the first is still running.
+            async with self._conversation_locks.hold(chat_id):
+                if state_info.step is ConversationStep.AWAITING_INTERVAL:
+                    await self._process_interval_input(chat_id, state_info.message_id, message.text)
+                elif state_info.step is ConversationStep.AWAITING_RESTORE_FILE:
+                    await self._process_restore_file(message, state_info.message_id)
+
+    def _spawn(self, coro: Awaitable[None]) -> asyncio.Task:
+        """Starts a background task and keeps a reference to it until it finishes."""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def _show_later(self, delay: float, display: Callable[[int, int], Awaitable[None]], chat_id: int, message_id: int):
+        """Schedules a follow-up screen instead of holding the handler in a sleep; a newer press on the message cancels it."""
+        key = (chat_id, message_id)
+        self._cancel_pending_display(chat_id, message_id)
+
+        def fire():
+            self._pending_displays.pop(key, None)
+            self._spawn(self._dispatch(display, chat_id, message_id))
+
+        self._pending_displays[key] = asyncio.get_running_loop().call_later(delay, fire)
+
+    def _cancel_pending_display(self, chat_id: int, message_id: int):
+        handle = self._pending_displays.pop((chat_id, message_id), None)
+        if handle:
+            handle.cancel()
+
+    async def _dispatch(self, handler: Callable[[int, int], Awaitable[None]], chat_id: int, message_id: int):
+        """Runs a callback handler in the background, serialized per edited message."""
+        async with self._dispatch_locks.hold((chat_id, message_id)):
+            try:
+                await handler(chat_id, message_id)
+            except Exception as e:
+                logger.error(f"Callback handler failed: {e}", exc_info=True)
 
     # --- Keyboard Generators ---
     def _get_main_menu_keyboard(self) -> InlineKeyboardMarkup:
         return quick_markup({
-            f"{EMOJI['BACKUP']} Backup": {'callback_data': self.CB_DO_BACKUP},
-            f"{EMOJI['RESTORE']} Restore": {'callback_data': self.CB_RESTORE_START},
-            f"{EMOJI['AUTO']} Auto Backup": {'callback_data': self.CB_AUTOBACKUP_MENU},
-            f"{EMOJI['STATUS']} System Status": {'callback_data': self.CB_SYSTEM_STATUS},
-            f"{EMOJI['LOGS']} View Logs": {'callback_data': self.CB_LOGS_MENU},
+            f"{EMOJI.BACKUP} Backup": {'callback_data': self.CB_DO_BACKUP},
+            f"{EMOJI.RESTORE} Restore": {'callback_data': self.CB_RESTORE_START},
+            f"{EMOJI.AUTO} Auto Backup": {'callback_data': self.CB_AUTOBACKUP_MENU},
+            f"{EMOJI.STATUS} System Status": {'callback_data': self.CB_SYSTEM_STATUS},
+            f"{EMOJI.LOGS} View Logs": {'callback_data': self.CB_LOGS_MENU},
         }, row_width=2)
 
-    def _get_autobackup_menu_keyboard(self) -> InlineKeyboardMarkup:
-        config = self.state_manager.get_config()
-        interval = config.get('telegram', {}).get('backup_interval')
-        is_enabled = bool(interval)
-        
-        toggle_text = f"{EMOJI['TOGGLE_OFF']} غیرفعال‌سازی" if is_enabled else f"{EMOJI['TOGGLE_ON']} فعال‌سازی"
+    def _get_autobackup_menu_keyboard(self, is_enabled: bool) -> InlineKeyboardMarkup:
+        toggle_text = f"{EMOJI.TOGGLE_OFF} غیرفعال‌سازی" if is_enabled else f"{EMOJI.TOGGLE_ON} فعال‌سازی"
         toggle_action = self.CB_AUTOBACKUP_DISABLE if is_enabled else self.CB_AUTOBACKUP_ENABLE
         
         markup_dict = {toggle_text: {'callback_data': toggle_action}}
         if is_enabled:
-            markup_dict[f"{EMOJI['EDIT']} تغییر بازه زمانی"] = {'callback_data': self.CB_AUTOBACKUP_EDIT}
+            markup_dict[f"{EMOJI.EDIT} تغییر بازه زمانی"] = {'callback_data': self.CB_AUTOBACKUP_EDIT}
         
-        markup_dict[f"{EMOJI['BACK']} بازگشت"] = {'callback_data': self.CB_MAIN_MENU}
+        markup_dict[f"{EMOJI.BACK} بازگشت"] = {'callback_data': self.CB_MAIN_MENU}
         return quick_markup(markup_dict, row_width=1)
 
+    def _get_logs_menu_keyboard(self) -> InlineKeyboardMarkup:
+        return quick_markup({
+            "📋 لاگ پنل (Backup/Restore)": {'callback_data': self.CB_VIEW_BACKUP_LOG},
+            "🤖 لاگ ربات (Bot)": {'callback_data': self.CB_VIEW_BOT_LOG},
+            f"{EMOJI.BACK} بازگشت": {'callback_data': self.CB_MAIN_MENU},
+        }, row_width=1)
+
+    def _get_restore_confirm_keyboard(self) -> InlineKeyboardMarkup:
+        return quick_markup({
+            f"{EMOJI.DANGER} بله، ریستور کن": {'callback_data': self.CB_RESTORE_CONFIRM},
+            f"{EMOJI.BACK} انصراف": {'callback_data': self.CB_MAIN_MENU},
+        })
+
+    def _get_back_keyboard(self, callback_data: str) -> InlineKeyboardMarkup:
+        return quick_markup({f"{EMOJI.BACK} بازگشت": {'callback_data': callback_data}})
+
     # --- Display Updaters ---
-    async def _update_display(self, chat_id: int, message_id: int, text: str, markup: Optional[InlineKeyboardMarkup] = None):
-        try:
-            await self.bot.edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode="Markdown")
-        except telebot.apihelper.ApiTelegramException as e:
-            if 'message is not modified' not in e.description:
+    def _markup_json(self, markup: Optional[InlineKeyboardMarkup]) -> Optional[str]:
+        """Serializes a keyboard once; the prebuilt keyboards are reused, so this is a dict hit afterwards."""
+        if markup is None:
+            return None
+        cached = self._markup_json_cache.get(id(markup))
+        if cached is None or cached[0] is not markup:
+            cached = (markup, markup.to_json())
+            self._markup_json_cache[id(markup)] = cached
+        return cached[1]
+
+    def _evict_edit_state(self):
+        """Forgets the edit bookkeeping of the least recently edited messages beyond EDIT_TRACKED_MESSAGES."""
+        while len(self._edit_seq) > EDIT_TRACKED_MESSAGES:
+            key, _ = self._edit_seq.popitem(last=False)
+            self._last_requested.pop(key, None)
+            self._edit_times.pop(key, None)
+
+    async def _update_display(self, chat_id: int, message_id: int, text: str, markup: Optional[InlineKeyboardMarkup] = None, parse_mode: Optional[str] = "Markdown"):
+        if parse_mode and MARKDOWN_SPECIAL_CHARS.isdisjoint(text):
+            parse_mode = None
+        key = (chat_id, message_id)
+        markup_json = self._markup_json(markup)
+        content_hash = hash((text, markup_json))
+        if self._last_requested.get(key) == content_hash:
+            return
+        self._last_requested[key] = content_hash
+        seq = self._edit_seq.get(key, 0) + 1
+        self._edit_seq[key] = seq
+        self._edit_seq.move_to_end(key)
+        self._evict_edit_state()
+        wait = EDIT_MIN_INTERVAL - (time.monotonic() - self._edit_times.get(key, 0.0))
+        if wait > 0:
+            await asyncio.sleep(wait)
+            if self._edit_seq.get(key) != seq:
+                return  # Coalesced: a newer edit for this message superseded this one.
+        self._edit_times[key] = time.monotonic()
+        for attempt in range(2):
+            try:
+                await self._send_bucket.acquire()
+                if self._edit_seq.get(key) != seq:
+                    return  # Superseded while waiting for a send slot.
+                # telebot passes a pre-serialized reply_markup through untouched.
+                await self.bot.edit_message_text(text, chat_id, message_id, reply_markup=markup_json, parse_mode=parse_mode)
+                return
+            except TELEGRAM_API_ERRORS as e:
+                if 'message is not modified' in e.description:
+                    return
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after') if e.error_code == 429 else None
+                if retry_after and attempt == 0:
+                    logger.warning(f"Rate limited by Telegram, retrying edit in {retry_after}s")
+                    await asyncio.sleep(retry_after)
+                    continue
+                if self._edit_seq.get(key) == seq:
+                    self._last_requested.pop(key, None)
                 logger.error(f"Failed to update display: {e}")
+                return
+            except TELEGRAM_NETWORK_ERRORS as e:
+                if self._edit_seq.get(key) == seq:
+                    self._last_requested.pop(key, None)
+                # Only the type: RequestTimeout's message carries the request URL, which embeds the bot token.
+                logger.error(f"Failed to update display: {type(e).__name__}")
+                return
     
     async def display_main_menu(self, chat_id: int, message_id: int):
-        state = self.state_manager.get_state()
-        config = self.state_manager.get_config()
+        state, settings = await asyncio.gather(self.state_manager.aget_state(), self.state_manager.aget_telegram_settings())
         
-        last_backup_str = state.get('last_backup_time', 'هیچوقت')
-        last_backup_display = last_backup_str
+        last_backup_str = state.get('last_backup_time')
         
-        if last_backup_str and 'ریستور' not in last_backup_str and last_backup_str != 'هیچوقت':
-            try:
-                last_backup_display = datetime.fromisoformat(last_backup_str).strftime('%Y-%m-%d %H:%M')
-            except (ValueError, TypeError):
-                logger.warning(f"Could not parse date: '{last_backup_str}'. Displaying as is.")
+        if not last_backup_str:
+            last_backup_display = 'هیچوقت (سیستم ریستور شده)' if state.get('last_restore_time') else 'هیچوقت'
+        else:
+            last_backup_display = format_backup_time(last_backup_str)
         
-        interval = config.get('telegram', {}).get('backup_interval')
-        auto_status = f"{EMOJI['TOGGLE_ON']} فعال (هر {interval} دقیقه)" if interval else f"{EMOJI['TOGGLE_OFF']} غیرفعال"
+        interval = settings.backup_interval
+        auto_status = f"{EMOJI.TOGGLE_ON} فعال (هر {interval} دقیقه)" if interval else f"{EMOJI.TOGGLE_OFF} غیرفعال"
         
-        text = (
-            f"*{EMOJI['PANEL']} Holographic Control Interface*\n\n"
-            f"`System Time..: ` `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`\n"
-            f"`Last Backup..: ` `{last_backup_display}`\n"
-            f"`Auto Backup..: ` {auto_status}\n\n"
-            "Awaiting command..."
+        text = self.MAIN_MENU_TEMPLATE.format(
+            panel=EMOJI.PANEL,
+            now=datetime.now().isoformat(sep=' ', timespec='seconds'),
+            last_backup=last_backup_display,
+            auto_status=auto_status
         )
-        await self._update_display(chat_id, message_id, text, self._get_main_menu_keyboard())
+        await self._update_display(chat_id, message_id, text, self._main_menu_markup)
 
     async def display_autobackup_menu(self, chat_id: int, message_id: int):
-        config = self.state_manager.get_config()
-        interval = config.get('telegram', {}).get('backup_interval')
+        interval = (await self.state_manager.aget_telegram_settings()).backup_interval
         status = f"در حال حاضر بکاپ خودکار *فعال* است و هر `{interval}` دقیقه یکبار اجرا می‌شود." if interval else "بکاپ خودکار در حال حاضر *غیرفعال* است."
-        text = f"{EMOJI['AUTO']} *مدیریت بکاپ خودکار*\n\n{status}\n\nاز دکمه‌های زیر برای مدیریت استفاده کنید."
-        await self._update_display(chat_id, message_id, text, self._get_autobackup_menu_keyboard())
+        text = f"{EMOJI.AUTO} *مدیریت بکاپ خودکار*\n\n{status}\n\nاز دکمه‌های زیر برای مدیریت استفاده کنید."
+        await self._update_display(chat_id, message_id, text, self._autobackup_markups[bool(interval)])
     
     async def display_logs_menu(self, chat_id: int, message_id: int):
-        text = f"{EMOJI['LOGS']} *مشاهده لاگ‌ها*\n\nکدام فایل لاگ را می‌خواهید مشاهده کنید؟ (نمایش ۲۰ خط آخر)"
-        markup = quick_markup({
-            "📋 لاگ پنل (Backup/Restore)": {'callback_data': self.CB_VIEW_BACKUP_LOG},
-            "🤖 لاگ ربات (Bot)": {'callback_data': self.CB_VIEW_BOT_LOG},
-            f"{EMOJI['BACK']} بازگشت": {'callback_data': self.CB_MAIN_MENU},
-        }, row_width=1)
-        await self._update_display(chat_id, message_id, text, markup)
+        await self._update_display(chat_id, message_id, self.LOGS_MENU_TEXT, self._logs_menu_markup)
         
     # --- Action Handlers ---
+    def _panel_busy(self) -> bool:
+        """True while a panel job runs or a button press that starts one has been dispatched but not finished."""
+        return self._panel_lock.locked() or any(data in self.PANEL_ACTIONS for data in self._inflight_presses.values())
+
+    async def _reject_if_panel_busy(self, chat_id: int, message_id: int) -> bool:
+        """Keeps a second panel job (backup, restore, schedule setup) from queueing up behind one that is still running."""
+        if not self._panel_lock.locked():
+            return False
+        await self._update_display(chat_id, message_id, self.PANEL_BUSY_TEXT)
+        self._show_later(3, self.display_main_menu, chat_id, message_id)
+        return True
+
     async def handle_backup(self, chat_id: int, message_id: int):
+        if await self._reject_if_panel_busy(chat_id, message_id):
+            return
         success, result, duration = await self.run_panel_script_streamed(['run-backup'], chat_id, message_id)
         if success:
-            self.state_manager.update_state('last_backup_time', datetime.utcnow().isoformat())
-            result_text = f"{EMOJI['SUCCESS']} *بکاپ کامل شد!* `({duration} ثانیه)`"
+            await self.state_manager.aupdate_state('last_backup_time', datetime.utcnow().isoformat(timespec='seconds'))
+            result_text = f"{EMOJI.SUCCESS} *بکاپ کامل شد!* `({duration} ثانیه)`"
         else:
-            result_text = f"{EMOJI['ERROR']} *عملیات ناموفق بود!*\n`{result}`"
+            result_text = f"{EMOJI.ERROR} *عملیات ناموفق بود!*\n`{result}`"
         
         await self._update_display(chat_id, message_id, result_text)
-        await asyncio.sleep(4)
-        await self.display_main_menu(chat_id, message_id)
+        self._show_later(4, self.display_main_menu, chat_id, message_id)
 
     async def handle_restore_start(self, chat_id: int, message_id: int):
-        text = (
-            f"{EMOJI['DANGER']} *هشدار بسیار مهم*\n\n"
-            "این عمل تمام اطلاعات فعلی شما را با فایل بکاپ *جایگزین* می‌کند. این عمل غیرقابل بازگشت است.\n\n"
-            "آیا برای ادامه مطمئن هستید؟"
-        )
-        markup = quick_markup({
-            f"{EMOJI['DANGER']} بله، ریستور کن": {'callback_data': self.CB_RESTORE_CONFIRM},
-            f"{EMOJI['BACK']} انصراف": {'callback_data': self.CB_MAIN_MENU},
-        })
-        await self._update_display(chat_id, message_id, text, markup)
+        if await self._reject_if_panel_busy(chat_id, message_id):
+            return
+        await self._update_display(chat_id, message_id, self.RESTORE_WARNING_TEXT, self._restore_confirm_markup)
         
     async def handle_restore_confirm(self, chat_id: int, message_id: int):
-        self.conversational_states[chat_id] = {'state': 'awaiting_restore_file', 'message_id': message_id}
-        await self._update_display(chat_id, message_id, f"{EMOJI['INFO']} لطفاً فایل بکاپ با فرمت `.tar.gz` را ارسال کنید.")
+        self.conversational_states[chat_id] = ConversationState(ConversationStep.AWAITING_RESTORE_FILE, message_id)
+        await self._update_display(chat_id, message_id, self.RESTORE_PROMPT_TEXT)
 
     async def handle_autobackup_set_interval(self, chat_id: int, message_id: int):
-        self.conversational_states[chat_id] = {'state': 'awaiting_interval', 'message_id': message_id}
-        await self._update_display(chat_id, message_id, f"{EMOJI['CLOCK']} لطفاً بازه زمانی بکاپ خودکار را به *دقیقه* وارد کنید (مثلا: `60`).")
+        self.conversational_states[chat_id] = ConversationState(ConversationStep.AWAITING_INTERVAL, message_id)
+        await self._update_display(chat_id, message_id, self.INTERVAL_PROMPT_TEXT)
         
     async def handle_autobackup_disable(self, chat_id: int, message_id: int):
-        await self._update_display(chat_id, message_id, f"{EMOJI['WAIT']} در حال غیرفعال‌سازی...")
+        await self._update_display(chat_id, message_id, self.AUTOBACKUP_DISABLING_TEXT)
         
-        config_data = self.state_manager.get_config()
-        config_data.get('telegram', {}).pop('backup_interval', None)
-        self.state_manager._save_json(CONFIG_FILE, config_data)
+        def clear_interval(config_data: Dict[str, Any]):
+            config_data.get('telegram', {}).pop('backup_interval', None)
+
+        await self.state_manager.amodify_config(clear_interval)
         
         success, output, _ = await self._run_panel_script(['do-auto-backup-setup'])
-        result_text = f"{EMOJI['SUCCESS']} بکاپ خودکار غیرفعال شد." if success else f"{EMOJI['ERROR']} خطا در به‌روزرسانی کرون‌جب:\n`{output}`"
+        result_text = self.AUTOBACKUP_DISABLED_TEXT if success else f"{EMOJI.ERROR} خطا در به‌روزرسانی کرون‌جب:\n`{output}`"
         
         await self._update_display(chat_id, message_id, result_text)
-        await asyncio.sleep(2)
-        await self.display_autobackup_menu(chat_id, message_id)
+        self._show_later(2, self.display_autobackup_menu, chat_id, message_id)
         
     async def handle_system_status(self, chat_id: int, message_id: int):
-        await self._update_display(chat_id, message_id, f"{EMOJI['WAIT']} در حال دریافت اطلاعات سیستم...")
+        await self._update_display(chat_id, message_id, self.STATUS_LOADING_TEXT)
         
         try:
-            tasks = [
-                asyncio.create_subprocess_shell("docker ps --format 'table {{.Names}}\\t{{.Status}}\\t{{.Ports}}'", stdout=asyncio.subprocess.PIPE),
-                asyncio.create_subprocess_shell("uptime -p", stdout=asyncio.subprocess.PIPE),
-                asyncio.create_subprocess_shell("free -h", stdout=asyncio.subprocess.PIPE),
-                asyncio.create_subprocess_shell("df -h /", stdout=asyncio.subprocess.PIPE)
-            ]
-            results = await asyncio.gather(*(p.communicate() for p in await asyncio.gather(*tasks)))
-            
-            stdout_ps, stdout_up, stdout_mem, stdout_disk = (res[0].decode('utf-8') for res in results)
+            stdout_ps, stdout_up, stdout_mem, stdout_disk = await asyncio.gather(
+                self._run_command_output('docker', 'ps', '--format', 'table {{.Names}}\t{{.Status}}\t{{.Ports}}'),
+                self._run_command_output('uptime', '-p'),
+                self._run_command_output('free', '-h'),
+                self._run_command_output('df', '-h', '/')
+            )
             
             status_text = (
-                f"{EMOJI['STATUS']} *وضعیت سیستم*\n\n"
+                f"{EMOJI.STATUS} *وضعیت سیستم*\n\n"
                 f"*Docker Containers:*\n```\n{stdout_ps}\n```\n"
                 f"*Uptime:*\n`{stdout_up.strip()}`\n\n"
                 f"*Memory Usage:*\n```\n{stdout_mem}\n```\n"
                 f"*Disk Usage (Root):*\n```\n{stdout_disk}\n```"
             )
         except Exception as e:
-            status_text = f"{EMOJI['ERROR']} *خطا در دریافت اطلاعات سیستم:*\n`{e}`"
+            status_text = f"{EMOJI.ERROR} *خطا در دریافت اطلاعات سیستم:*\n`{e}`"
 
-        markup = quick_markup({f"{EMOJI['BACK']} بازگشت": {'callback_data': self.CB_MAIN_MENU}})
-        await self._update_display(chat_id, message_id, status_text, markup)
+        await self._update_display(chat_id, message_id, status_text, self._back_to_main_markup)
     
     async def handle_view_log(self, chat_id: int, message_id: int, log_path: Path):
-        await self._update_display(chat_id, message_id, f"{EMOJI['WAIT']} در حال خواندن فایل لاگ...")
+        await self._update_display(chat_id, message_id, self.LOG_LOADING_TEXT)
         
         try:
             if not log_path.exists():
                 raise FileNotFoundError(f"فایل لاگ پیدا نشد: {log_path.name}")
 
-            proc = await asyncio.create_subprocess_shell(f"tail -n 20 {log_path}", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            stdout, stderr = await proc.communicate()
-            
-            if proc.returncode == 0:
-                log_content = stdout.decode('utf-8', errors='ignore').strip()
-                text = f"{EMOJI['LOGS']} *نمایش 20 خط آخر از `{log_path.name}`*\n\n```\n{log_content or 'فایل لاگ خالی است.'}\n```"
-            else:
-                text = f"{EMOJI['ERROR']} *خطا در خواندن لاگ:*\n`{stderr.decode('utf-8', errors='ignore')}`"
+            log_content = (await self._tail_file(log_path, LOG_TAIL_LINES)).strip()
+            text = f"{EMOJI.LOGS} *نمایش {LOG_TAIL_LINES} خط آخر از `{log_path.name}`*\n\n```\n{log_content or 'فایل لاگ خالی است.'}\n```"
         
         except Exception as e:
-            text = f"{EMOJI['ERROR']} *خطا در پردازش فایل لاگ:*\n`{e}`"
+            text = f"{EMOJI.ERROR} *خطا در پردازش فایل لاگ:*\n`{e}`"
 
-        markup = quick_markup({f"{EMOJI['BACK']} بازگشت": {'callback_data': self.CB_LOGS_MENU}})
-        await self._update_display(chat_id, message_id, text, markup)
+        await self._update_display(chat_id, message_id, text, self._back_to_logs_markup)
         
     async def _process_interval_input(self, chat_id: int, message_id: int, text_input: str):
         try:
             interval = int(text_input)
             if interval <= 0: raise ValueError("Interval must be positive.")
+            if await self._reject_if_panel_busy(chat_id, message_id):
+                return
             
-            await self._update_display(chat_id, message_id, f"{EMOJI['WAIT']} در حال تنظیم بازه زمانی روی `{interval}` دقیقه...")
+            await self._update_display(chat_id, message_id, f"{EMOJI.WAIT} در حال تنظیم بازه زمانی روی `{interval}` دقیقه...")
             
-            config_data = self.state_manager.get_config()
-            config_data.setdefault('telegram', {})['backup_interval'] = str(interval)
-            self.state_manager._save_json(CONFIG_FILE, config_data)
+            def set_interval(config_data: Dict[str, Any]):
+                config_data.setdefault('telegram', {})['backup_interval'] = str(interval)
+
+            await self.state_manager.amodify_config(set_interval)
             
-            success, output, _ = await self._run_panel_script(['do-auto-backup-setup'])
-            result_text = f"{EMOJI['SUCCESS']} زمان‌بندی با موفقیت به‌روز شد." if success else f"{EMOJI['ERROR']} خطا در به‌روزرسانی کرون‌جب:\n`{output}`"
+            # With an interval set, the setup run also takes an initial backup, which may legitimately run long.
+            success, output, _ = await self._run_panel_script(['do-auto-backup-setup'], timeout=None)
+            result_text = self.SCHEDULE_UPDATED_TEXT if success else f"{EMOJI.ERROR} خطا در به‌روزرسانی کرون‌جب:\n`{output}`"
             
             await self._update_display(chat_id, message_id, result_text)
-            await asyncio.sleep(2)
-            await self.display_autobackup_menu(chat_id, message_id)
+            self._show_later(2, self.display_autobackup_menu, chat_id, message_id)
             
         except (ValueError, TypeError):
-            await self._update_display(chat_id, message_id, f"{EMOJI['ERROR']} ورودی نامعتبر است. لطفاً فقط یک عدد صحیح مثبت وارد کنید.")
-            await asyncio.sleep(3)
-            await self.display_autobackup_menu(chat_id, message_id)
+            await self._update_display(chat_id, message_id, self.INVALID_INTERVAL_TEXT)
+            self._show_later(3, self.display_autobackup_menu, chat_id, message_id)
 
     async def _process_restore_file(self, message, msg_id_to_edit):
         chat_id = message.chat.id
         
         if message.content_type != 'document' or not message.document.file_name.endswith('.tar.gz'):
-            await self._update_display(chat_id, msg_id_to_edit, f"{EMOJI['ERROR']} فایل نامعتبر است. لطفاً فایل با فرمت `.tar.gz` ارسال کنید.")
-            await asyncio.sleep(3)
-            await self.display_main_menu(chat_id, msg_id_to_edit)
+            await self._update_display(chat_id, msg_id_to_edit, self.INVALID_FILE_TEXT)
+            self._show_later(3, self.display_main_menu, chat_id, msg_id_to_edit)
+            return
+        if await self._reject_if_panel_busy(chat_id, msg_id_to_edit):
             return
 
-        await self._update_display(chat_id, msg_id_to_edit, f"{EMOJI['WAIT']} در حال دانلود فایل...")
+        await self._update_display(chat_id, msg_id_to_edit, self.DOWNLOADING_TEXT)
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".tar.gz", prefix="restore_") as temp_file:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".tar.gz", prefix="marzban-restore-") as temp_file:
             restore_file_path = Path(temp_file.name)
+        try:
+            file_info = await self.bot.get_file(message.document.file_id)
+            local_file_path = Path(file_info.file_path)
+
             try:
-                file_info = await self.bot.get_file(message.document.file_id)
-                downloaded_file = await self.bot.download_file(file_info.file_path)
-                temp_file.write(downloaded_file)
-                temp_file.flush()
-
-                success, result, duration = await self.run_panel_script_streamed(['do-restore', str(restore_file_path)], chat_id, msg_id_to_edit)
-                
-                if success:
-                    self.state_manager.update_state('last_backup_time', 'هیچوقت (سیستم ریستور شده)')
-                    result_text = f"{EMOJI['SUCCESS']} *ریستور کامل شد!* `({duration}s)`"
+                if local_file_path.is_absolute() and local_file_path.is_file():
+                    # A local Bot API server (--local) hands out paths on this host; use the file directly.
+                    archive_path = local_file_path
                 else:
-                    result_text = f"{EMOJI['ERROR']} *ریستور ناموفق بود!*\n`{result}`"
-                
-                await self._update_display(chat_id, msg_id_to_edit, result_text)
-                await asyncio.sleep(4)
-                await self.display_main_menu(chat_id, msg_id_to_edit)
+                    await self._download_to_path(file_info.file_path, restore_file_path, expected_magic=GZIP_MAGIC)
+                    archive_path = restore_file_path
+                await asyncio.to_thread(validate_backup_archive, archive_path)
+            except ValueError as e:
+                await self._update_display(chat_id, msg_id_to_edit, f"{EMOJI.ERROR} فایل بکاپ نامعتبر است:\n`{e}`")
+                self._show_later(3, self.display_main_menu, chat_id, msg_id_to_edit)
+                return
 
+            # The download can take a while; a backup may have started meanwhile.
+            if await self._reject_if_panel_busy(chat_id, msg_id_to_edit):
+                return
+            success, result, duration = await self.run_panel_script_streamed(['do-restore', str(archive_path)], chat_id, msg_id_to_edit)
+            
+            if success:
+                await self.state_manager.aupdate_state('last_backup_time', None)
+                await self.state_manager.aupdate_state('last_restore_time', datetime.utcnow().isoformat(timespec='seconds'))
+                result_text = f"{EMOJI.SUCCESS} *ریستور کامل شد!* `({duration}s)`"
+            else:
+                result_text = f"{EMOJI.ERROR} *ریستور ناموفق بود!*\n`{result}`"
+            
+            await self._update_display(chat_id, msg_id_to_edit, result_text)
+            self._show_later(4, self.display_main_menu, chat_id, msg_id_to_edit)
+
+        except Exception as e:
+            logger.error(f"Error during restore file processing: {e}", exc_info=True)
+            await self._update_display(chat_id, msg_id_to_edit, f"{EMOJI.ERROR} خطای پیش‌بینی نشده در پردازش فایل:\n`{e}`")
+            self._show_later(3, self.display_main_menu, chat_id, msg_id_to_edit)
+        finally:
+            restore_file_path.unlink(missing_ok=True)
+
+    # --- Utility Methods ---
+    async def _download_to_path(self, telegram_file_path: str, destination: Path, expected_magic: Optional[bytes] = None):
+        """Streams a Telegram file to disk in chunks, aborting early if it does not start with `expected_magic`."""
+        file_url = (asyncio_helper.FILE_URL or TELEGRAM_FILE_URL).format(self.bot.token, telegram_file_path)
+        session = await asyncio_helper.session_manager.get_session()
+        async with session.get(file_url, timeout=aiohttp.ClientTimeout(total=None, sock_read=DOWNLOAD_READ_TIMEOUT)) as response:
+            if response.status != 200:
+                # Not raise_for_status(): its message carries the file URL, which embeds the bot token.
+                raise RuntimeError(f"Telegram file download failed with HTTP {response.status} for '{telegram_file_path}'")
+            async with aiofiles.open(destination, 'wb') as out:
+                if expected_magic:
+                    try:
+                        head = await response.content.readexactly(len(expected_magic))
+                    except asyncio.IncompleteReadError:
+                        head = b""
+                    if head != expected_magic:
+                        raise ValueError("File is not a gzip archive.")
+                    await out.write(head)
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await out.write(chunk)
+
+    async def _tail_file(self, path: Path, line_count: int) -> str:
+        """Returns the last `line_count` lines of a file by reading backwards from its end."""
+        async with aiofiles.open(path, 'rb') as f:
+            await f.seek(0, os.SEEK_END)
+            position = await f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= line_count:
+                read_size = min(LOG_TAIL_CHUNK_SIZE, position)
+                position -= read_size
+                await f.seek(position)
+                data = await f.read(read_size) + data
+        return b"\n".join(data.splitlines()[-line_count:]).decode('utf-8', errors='ignore')
+
+    async def _run_command_output(self, *argv: str) -> str:
+        """Execs a command without a shell and returns its decoded stdout once it exits."""
+        try:
+            process = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE)
+        except FileNotFoundError:
+            return f"{argv[0]}: command not found"
+        stdout, _ = await process.communicate()
+        return stdout.decode('utf-8', errors='ignore')
+
+    def _load_panel_module(self):
+        """Imports the panel for in-process runs when the bot already has root privileges."""
+        if os.geteuid() != 0:
+            return None
+        try:
+            import marzban_panel
+        except (ImportError, SystemExit) as e:
+            logger.warning(f"Could not import panel module, falling back to subprocess runs: {e}")
+            return None
+        file_handler = RotatingFileHandler(marzban_panel.LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8', delay=True)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+        marzban_panel.logger.addHandler(file_handler)
+        marzban_panel.logger.propagate = False
+        return marzban_panel
+
+    async def _run_panel_in_process(self, args: List[str], chat_id: Optional[int] = None, message_id: Optional[int] = None) -> Tuple[bool, str, str]:
+        """Runs a panel command in a worker thread, relaying its log lines as progress."""
+        collector = PanelLogCollector()
+        panel_logger = self._panel_module.logger
+        start_time = time.time()
+        async with self._panel_lock:
+            panel_logger.addHandler(collector)
+            try:
+                task = asyncio.get_running_loop().run_in_executor(self._panel_executor, self._panel_module.run_command, args)
+                last_shown = None
+                while not task.done():
+                    await asyncio.wait({task}, timeout=PROGRESS_UPDATE_INTERVAL)
+                    if chat_id is None or not collector.lines or collector.lines[-1] == last_shown:
+                        continue
+                    last_shown = collector.lines[-1]
+                    progress_text = self.PROGRESS_TEMPLATE.format(line=last_shown)
+                    await self._update_display(chat_id, message_id, progress_text, parse_mode=None)
+                exit_code = task.result()
             except Exception as e:
-                logger.error(f"Error during restore file processing: {e}", exc_info=True)
-                await self._update_display(chat_id, msg_id_to_edit, f"{EMOJI['ERROR']} خطای پیش‌بینی نشده در پردازش فایل:\n`{e}`")
-                await asyncio.sleep(3)
-                await self.display_main_menu(chat_id, msg_id_to_edit)
+                logger.error(f"In-process panel command failed. Args: {args}", exc_info=True)
+                collector.lines.append(str(e))
+                exit_code = 1
             finally:
-                if restore_file_path.exists():
-                    restore_file_path.unlink()
+                panel_logger.removeHandler(collector)
+        duration = f"{time.time() - start_time:.2f}"
+        return exit_code == 0, "\n".join(collector.lines), duration
 
-    # --- Utility Methods ---
-    async def _run_panel_script(self, args: List[str]) -> Tuple[bool, str, str]:
-        """Runs the panel script and waits for completion (for short tasks)."""
-        venv_python = SCRIPT_DIR / 'venv' / 'bin' / 'python3'
-        python_executable = str(venv_python) if venv_python.exists() else "python3"
-        command = ['sudo', python_executable, str(MAIN_PANEL_SCRIPT)] + args
+    async def _run_panel_script(self, args: List[str], timeout: Optional[float] = PANEL_SCRIPT_TIMEOUT) -> Tuple[bool, str, str]:
+        """Runs the panel script and waits for completion (for short tasks); `timeout=None` for runs that include a backup."""
+        if self._panel_module:
+            return await self._run_panel_in_process(args)
+        async with self._panel_lock:
+            return await self._run_panel_subprocess(args, timeout)
+
+    async def _run_panel_subprocess(self, args: List[str], timeout: Optional[float]) -> Tuple[bool, str, str]:
+        command = ['sudo', PANEL_PYTHON, str(MAIN_PANEL_SCRIPT)] + args
         
         start_time = time.time()
-        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await process.communicate()
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        communicate = asyncio.ensure_future(process.communicate())
+        try:
+            stdout, _ = await asyncio.wait_for(asyncio.shield(communicate), timeout=timeout)
+        except asyncio.TimeoutError:
+            if process.returncode is None:
+                process.terminate()
+            try:
+                await asyncio.wait_for(asyncio.shield(communicate), timeout=PANEL_TERMINATE_GRACE)
+            except asyncio.TimeoutError:
+                if process.returncode is None:
+                    process.kill()
+                await communicate
+            duration = f"{time.time() - start_time:.2f}"
+            logger.error(f"Panel script timed out after {timeout}s. Args: {args}")
+            return False, f"Timed out after {timeout} seconds.", duration
         duration = f"{time.time() - start_time:.2f}"
+        output = stdout.decode('utf-8', errors='ignore').strip()
         
-        if process.returncode == 0:
-            return True, stdout.decode('utf-8').strip(), duration
-        else:
-            error = stderr.decode('utf-8').strip() + "\n" + stdout.decode('utf-8').strip()
-            return False, error.strip(), duration
+        return process.returncode == 0, output, duration
+            
+    async def _drain_stream(self, stream: asyncio.StreamReader, output_lines: Deque[str]):
+        """Reads a subprocess stream to EOF in large chunks, appending each non-empty line."""
+        pending = b""
+        while True:
+            chunk = await stream.read(STREAM_CHUNK_SIZE)
+            if not chunk: break
+            
+            complete, newline, pending = (pending + chunk).rpartition(b"\n")
+            if not newline: continue
             
+            lines = (line.strip() for line in complete.decode('utf-8', errors='ignore').split("\n"))
+            output_lines.extend(line for line in lines if line)
+
+        tail = pending.decode('utf-8', errors='ignore').strip()
+        if tail:
+            output_lines.append(tail)
+
     async def run_panel_script_streamed(self, args: List[str], chat_id: int, message_id: int) -> Tuple[bool, str, str]:
         """Runs the panel script and streams live feedback (for long tasks)."""
-        venv_python = SCRIPT_DIR / 'venv' / 'bin' / 'python3'
-        python_executable = str(venv_python) if venv_python.exists() else "python3"
-        command = ['sudo', '-E', python_executable, str(MAIN_PANEL_SCRIPT)] + args
+        if self._panel_module:
+            return await self._run_panel_in_process(args, chat_id, message_id)
+        async with self._panel_lock:
+            return await self._run_panel_subprocess_streamed(args, chat_id, message_id)
+
+    async def _run_panel_subprocess_streamed(self, args: List[str], chat_id: int, message_id: int) -> Tuple[bool, str, str]:
+        command = ['sudo', '-E', PANEL_PYTHON, str(MAIN_PANEL_SCRIPT)] + args
         
         start_time = time.time()
         process = await asyncio.create_subprocess_exec(
-            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+            limit=STREAM_BUFFER_LIMIT
         )
 
-        full_output = ""
-        last_update_time = time.time()
+        output_lines: Deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+        reader = asyncio.create_task(self._drain_stream(process.stdout, output_lines))
+        last_sent_line = None
         
-        while True:
-            line_bytes = await process.stdout.readline()
-            if not line_bytes: break
-            
-            decoded_line = line_bytes.decode('utf-8', errors='ignore').strip()
-            if not decoded_line: continue
-            
-            full_output += decoded_line + "\n"
-            
-            if time.time() - last_update_time > 1.5:
-                progress_text = f"{EMOJI['WAIT']} *عملیات در حال انجام...*\n\n`{decoded_line}`"
-                await self._update_display(chat_id, message_id, progress_text)
-                last_update_time = time.time()
+        while not reader.done():
+            await asyncio.wait({reader}, timeout=PROGRESS_UPDATE_INTERVAL)
+            if reader.done() or not output_lines or output_lines[-1] == last_sent_line:
+                continue
+            last_sent_line = output_lines[-1]
+            progress_text = self.PROGRESS_TEMPLATE.format(line=last_sent_line)
+            await self._update_display(chat_id, message_id, progress_text, parse_mode=None)
+
+        await reader
+        full_output = "\n".join(output_lines)
 
         await process.wait()
         duration = f"{time.time() - start_time:.2f}"
@@ -460,28 +1040,74 @@ class MarzbanControlBot:
             return call_or_msg.message.chat.id, call_or_msg.message.message_id
         return call_or_msg.chat.id, call_or_msg.message_id
 
-    async def run(self):
-        """Starts the bot's polling loop."""
+    async def _run_webhook(self, webhook: Dict[str, Any]):
+        """Serves updates pushed by Telegram instead of long-polling getUpdates."""
+        url = webhook['url']
+        secret = secrets.token_urlsafe(32)
+
+        async def handle_update(request: web.Request) -> web.Response:
+            if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                return web.Response(status=403)
+            update = telebot.types.Update.de_json(await request.text())
+            self._spawn(self.bot.process_new_updates([update]))
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(urlsplit(url).path or '/', handle_update)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, webhook.get('listen', WEBHOOK_LISTEN), int(webhook.get('port', WEBHOOK_PORT)))
+            await site.start()
+            await self.bot.set_webhook(
+                url=url, secret_token=secret, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True
+            )
+            logger.info(f"Webhook registered at {url}")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def run(self, webhook: Optional[Dict[str, Any]] = None):
+        """Starts the bot, via webhook when configured, otherwise via long polling."""
         logger.info(f"Starting Bot v9.4 for Admin ID: {self.admin_id}...")
-        while True:
-            try:
-                await self.bot.polling(non_stop=True, timeout=120)
-            except Exception as e:
-                logger.critical(f"Bot polling crashed with error: {e}. Restarting in 10 seconds.", exc_info=True)
-                await asyncio.sleep(10)
+        backoff = POLLING_BACKOFF_INITIAL
+        # Only a fresh process drops the backlog; polling restarts keep the offset and lose nothing.
+        skip_pending = True
+        try:
+            if webhook and webhook.get('url'):
+                await self._run_webhook(webhook)
+                return
+            while True:
+                try:
+                    await self.bot.remove_webhook()
+                    await self.bot.polling(
+                        non_stop=True, skip_pending=skip_pending, timeout=LONG_POLLING_TIMEOUT,
+                        request_timeout=POLLING_REQUEST_TIMEOUT, allowed_updates=ALLOWED_UPDATES
+                    )
+                    backoff = POLLING_BACKOFF_INITIAL
+                except Exception as e:
+                    logger.critical(f"Bot polling crashed with error: {e}. Restarting in {backoff} seconds.", exc_info=True)
+                    skip_pending = False
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, POLLING_BACKOFF_MAX)
+        finally:
+            session = asyncio_helper.session_manager.session
+            if session and not session.closed:
+                await session.close()
 
 
 if __name__ == '__main__':
     try:
-        config = StateManager(CONFIG_FILE, BOT_STATE_FILE).get_config()
-        bot_token = config.get('telegram', {}).get('bot_token')
-        admin_id_str = config.get('telegram', {}).get('admin_chat_id')
+        state_manager = StateManager(CONFIG_FILE, BOT_STATE_FILE)
+        settings = TelegramSettings.from_config(state_manager.get_config())
+        configure_api_server(settings.api_server)
         
-        if not bot_token or not admin_id_str:
+        if not settings.bot_token or not settings.admin_chat_id:
             raise ValueError("Bot Token or Admin Chat ID is missing in config.json")
             
-        bot_instance = MarzbanControlBot(token=bot_token, admin_id=int(admin_id_str))
-        asyncio.run(bot_instance.run())
+        bot_instance = MarzbanControlBot(token=settings.bot_token, admin_id=int(settings.admin_chat_id), state_manager=state_manager)
+        asyncio.run(bot_instance.run(webhook=settings.webhook))
 
     except (ValueError, KeyError) as e:
         logger.critical(f"FATAL: Config error. Ensure 'bot_token' and 'admin_chat_id' are set. Error: {e}")
@@ -12,14 +12,14 @@ import subprocess
 import json
 import shutil
 import tarfile
-from time import sleep
+from time import sleep, monotonic
 from datetime import datetime
-import requests
 from subprocess import Popen, PIPE
 import tempfile
 import logging
 from logging.handlers import RotatingFileHandler
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple, Deque
+from collections import deque
 from pathlib import Path
 
 try:
@@ -32,6 +32,11 @@ except ImportError:
     print("FATAL ERROR: 'rich' library is not installed. Please run 'pip3 install rich'.")
     sys.exit(1)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- Global Configuration ---
 SCRIPT_DIR = Path(__file__).resolve().parent
 CONFIG_FILE = SCRIPT_DIR / "config.json"
@@ -46,13 +51,16 @@ MARZBAN_SERVICE_PATH = Path("/opt/marzban")
 LOG_FILE = SCRIPT_DIR / "marzban_backup.log"
 TG_BOT_FILE_NAME = "marzban_bot.py"
 DOTENV_PATH = MARZBAN_SERVICE_PATH / ".env"
+TELEGRAM_API_SERVER = "https://api.telegram.org"
+DB_CONTAINER_CACHE_TTL = 300
+COMMAND_OUTPUT_TAIL_LINES = 5
 
 # --- Setup Logging ---
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
     handlers=[
-        RotatingFileHandler(LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5),
+        RotatingFileHandler(LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8', delay=True),
         logging.StreamHandler(sys.stdout)
     ]
 )
@@ -86,12 +94,19 @@ def show_main_menu() -> str:
     ))
     return Prompt.ask("[prompt]Enter your choice[/prompt]", choices=["1", "2", "3", "4", "5"], default="5")
 
+def json_loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def json_dumps(data: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=4).encode('utf-8')
+
 def load_config_file() -> Optional[Dict[str, Any]]:
-    if not CONFIG_FILE.exists():
-        return None
     try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return json_loads(CONFIG_FILE.read_bytes())
+    except FileNotFoundError:
+        return None
     except json.JSONDecodeError:
         log_message("Invalid config file format. It will be recreated.", "danger")
         return None
@@ -99,25 +114,51 @@ def load_config_file() -> Optional[Dict[str, Any]]:
 def save_config_file(config: Dict[str, Any]):
     """Saves the provided config dictionary to the config file."""
     try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=4)
+        fd, tmp_name = tempfile.mkstemp(dir=CONFIG_FILE.parent, prefix=f".{CONFIG_FILE.name}.", suffix=".tmp")
+        try:
+            with open(fd, 'wb') as f:
+                # mkstemp creates the file 0600; keep whatever mode the existing config already had.
+                if CONFIG_FILE.exists():
+                    os.fchmod(f.fileno(), CONFIG_FILE.stat().st_mode & 0o7777)
+                f.write(json_dumps(config))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_name, CONFIG_FILE)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
     except Exception as e:
         log_message(f"Failed to save config file: {e}", "danger")
 
 def find_dotenv_password() -> Optional[str]:
-    if not DOTENV_PATH.exists():
-        return None
     try:
         with open(DOTENV_PATH, 'r', encoding='utf-8') as f:
             for line in f:
                 if line.strip().startswith(('MYSQL_ROOT_PASSWORD=', 'MARIADB_ROOT_PASSWORD=')):
                     return line.strip().split('=', 1)[1].strip()
             return None
+    except FileNotFoundError:
+        return None
     except Exception as e:
         log_message(f"Error reading .env file: {e}", "danger")
         return None
 
+_db_container_cache: Dict[str, Any] = {"value": None, "ts": None}
+
 def find_database_container() -> Optional[str]:
+    ts = _db_container_cache["ts"]
+    if ts is not None and monotonic() - ts < DB_CONTAINER_CACHE_TTL:
+        return _db_container_cache["value"]
+    container_name = _detect_database_container()
+    # Never cache a miss: a container that is restarting must not make later backups skip the dump.
+    if container_name:
+        _db_container_cache.update(value=container_name, ts=monotonic())
+    return container_name
+
+def invalidate_database_container_cache():
+    _db_container_cache["ts"] = None
+
+def _detect_database_container() -> Optional[str]:
     try:
         cmd = "docker ps -a --format '{{.Names}} {{.Image}}' | grep -E 'mysql|mariadb'"
         result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
@@ -172,38 +213,55 @@ def log_message(message: str, style: str = "info"):
     else:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
 
+def stream_command(command: str) -> Tuple[int, str]:
+    """Runs a shell command, logging each output line as it arrives; returns (exit code, output tail)."""
+    tail: Deque[str] = deque(maxlen=COMMAND_OUTPUT_TAIL_LINES)
+    with Popen(command, shell=True, stdout=PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, executable='/bin/bash') as proc:
+        for line in proc.stdout:
+            line = line.rstrip()
+            if line:
+                tail.append(line)
+                logger.info(line)
+    return proc.returncode, "\n".join(tail)
+
 def run_marzban_command(action: str) -> bool:
     if not MARZBAN_SERVICE_PATH.is_dir():
         log_message("Marzban path not found. Is it installed?", "danger")
         return False
-    command = f"cd {MARZBAN_SERVICE_PATH} && docker compose {action}"
-    try:
-        log_message(f"Running command: docker compose {action}", "info")
-        subprocess.run(command, shell=True, check=True, capture_output=True, text=True, executable='/bin/bash')
+    invalidate_database_container_cache()
+    log_message(f"Running command: docker compose {action}", "info")
+    returncode, output = stream_command(f"cd {MARZBAN_SERVICE_PATH} && docker compose {action}")
+    if returncode == 0:
         return True
-    except subprocess.CalledProcessError as e:
-        log_message(f"Command with 'docker compose' failed: {e.stderr}", "warning")
-    command = f"cd {MARZBAN_SERVICE_PATH} && docker-compose {action}"
-    try:
-        log_message(f"Attempting command with 'docker-compose': docker-compose {action}", "info")
-        subprocess.run(command, shell=True, check=True, capture_output=True, text=True, executable='/bin/bash')
+    log_message(f"Command with 'docker compose' failed: {output}", "warning")
+    log_message(f"Attempting command with 'docker-compose': docker-compose {action}", "info")
+    returncode, output = stream_command(f"cd {MARZBAN_SERVICE_PATH} && docker-compose {action}")
+    if returncode == 0:
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        stderr = getattr(e, 'stderr', str(e))
-        log_message(f"Command with 'docker-compose' failed: {stderr}", "danger")
-        return False
+    log_message(f"Command with 'docker-compose' failed: {output}", "danger")
     return False
 
 # =================================================================
 # CORE LOGIC
 # =================================================================
 
+def send_telegram_document(url: str, data: Dict[str, Any], files: Optional[Dict[str, Any]] = None):
+    """Posts to sendDocument; errors never include the URL, since it embeds the bot token."""
+    import requests  # Deferred: only backups that upload to Telegram need it.
+    try:
+        response = requests.post(url, data=data, files=files, timeout=300)
+    except requests.RequestException as e:
+        raise RuntimeError(f"Telegram request failed: {e.__class__.__name__}") from None
+    if not response.ok:
+        raise RuntimeError(f"Telegram returned HTTP {response.status_code}: {response.text[:200]}")
+
 def run_full_backup(config: Dict[str, Any], is_cron: bool = False):
     log_message("Starting full backup process...", "info")
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     backup_temp_dir = Path(tempfile.mkdtemp(prefix="hexbackup_"))
     final_archive_path = Path(f"/root/marzban_backup_{timestamp}.tar.gz")
     final_archive_path.parent.mkdir(parents=True, exist_ok=True)
+    sent_to_telegram = False
     try:
         container_name = find_database_container()
         db_config = config.get('database', {})
@@ -247,10 +305,21 @@ def run_full_backup(config: Dict[str, Any], is_cron: bool = False):
         tg_config = config.get('telegram', {})
         if tg_config.get('bot_token') and tg_config.get('admin_chat_id'):
             log_message("Sending backup to Telegram...", "info")
-            url = f"https://api.telegram.org/bot{tg_config['bot_token']}/sendDocument"
+            api_server = (tg_config.get('api_server') or TELEGRAM_API_SERVER).rstrip('/')
+            url = f"{api_server}/bot{tg_config['bot_token']}/sendDocument"
             caption = f"✅ Marzban Backup ({'Auto' if is_cron else 'Manual'})\n📅 {timestamp}"
-            with open(final_archive_path, 'rb') as f:
-                requests.post(url, data={'chat_id': tg_config['admin_chat_id'], 'caption': caption}, files={'document': f}, timeout=300).raise_for_status()
+            data = {'chat_id': tg_config['admin_chat_id'], 'caption': caption}
+            if tg_config.get('local_mode'):
+                # A Bot API server started with --local on this host reads file:// documents straight from disk.
+                try:
+                    send_telegram_document(url, {**data, 'document': final_archive_path.resolve().as_uri()})
+                    sent_to_telegram = True
+                except RuntimeError as e:
+                    log_message(f"Sending by local path failed ({e}), uploading the file instead...", "warning")
+            if not sent_to_telegram:
+                with open(final_archive_path, 'rb') as f:
+                    send_telegram_document(url, data, files={'document': f})
+                sent_to_telegram = True
             log_message("Backup sent to Telegram!", "success")
     except Exception as e:
         log_message(f"A critical error occurred during backup: {e}", "danger")
@@ -259,8 +328,11 @@ def run_full_backup(config: Dict[str, Any], is_cron: bool = False):
         log_message("Cleaning up temporary files...", "info")
         shutil.rmtree(backup_temp_dir, ignore_errors=True)
         if is_cron and final_archive_path.exists():
-            os.remove(final_archive_path)
-            log_message("Removed local cron backup file.", "info")
+            if sent_to_telegram:
+                os.remove(final_archive_path)
+                log_message("Removed local cron backup file.", "info")
+            else:
+                log_message(f"Backup was not delivered to Telegram; keeping it at '{final_archive_path}'.", "warning")
 
 def _perform_restore(archive_path: Path, config: Dict[str, Any]):
     temp_dir = Path(tempfile.mkdtemp(prefix="restore_"))
@@ -377,7 +449,7 @@ def setup_bot_flow():
         log_message("Installing required Python libraries for the bot...", "info")
         venv_pip = SCRIPT_DIR / 'venv' / 'bin' / 'pip'
         pip_executable = str(venv_pip) if venv_pip.exists() else 'pip3'
-        subprocess.check_call([pip_executable, "install", "--upgrade", "pyTelegramBotAPI", "aiohttp", "aiofiles"])
+        subprocess.check_call([pip_executable, "install", "--upgrade", "pyTelegramBotAPI", "aiohttp", "aiofiles", "orjson"])
         
         service_file_path = Path("/etc/systemd/system/marzban_bot.service")
         venv_python = SCRIPT_DIR / 'venv' / 'bin' / 'python3'
@@ -465,25 +537,29 @@ def setup_cronjob_flow(interactive: bool = True):
     except Exception as e:
         log_message(f"Error updating crontab: {str(e)}", "danger")
 
+def run_command(args: List[str]) -> int:
+    """Runs a non-interactive command (as used by cron and the bot) and returns its exit code."""
+    command = args[0]
+    config = load_config_file()
+    if not config:
+        log_message("Configuration file not found. Cannot run non-interactively.", "danger")
+        return 1
+    if command == 'run-backup':
+        run_full_backup(config, is_cron=True)
+    elif command == 'do-restore':
+        if len(args) > 1:
+            archive_path = Path(args[1])
+            if archive_path.is_file(): _perform_restore(archive_path, config)
+            else: log_message(f"Backup file not found: {archive_path}", "danger"); return 1
+        else:
+            log_message("Error: Restore command requires a file path argument.", "danger"); return 1
+    elif command == 'do-auto-backup-setup':
+         setup_cronjob_flow(interactive=False)
+    return 0
+
 def main():
     if len(sys.argv) > 1:
-        command = sys.argv[1]
-        config = load_config_file()
-        if not config:
-            log_message("Configuration file not found. Cannot run non-interactively.", "danger")
-            sys.exit(1)
-        if command == 'run-backup':
-            run_full_backup(config, is_cron=True)
-        elif command == 'do-restore':
-            if len(sys.argv) > 2:
-                archive_path = Path(sys.argv[2])
-                if archive_path.is_file(): _perform_restore(archive_path, config)
-                else: log_message(f"Backup file not found: {archive_path}", "danger"); sys.exit(1)
-            else:
-                log_message("Error: Restore command requires a file path argument.", "danger"); sys.exit(1)
-        elif command == 'do-auto-backup-setup':
-             setup_cronjob_flow(interactive=False)
-        sys.exit(0)
+        sys.exit(run_command(sys.argv[1:]))
 
     if os.geteuid() != 0:
         log_message("This script requires root privileges. Please run with 'sudo'.", "danger")